@@ -1,7 +1,38 @@
-import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Any
 
+from utils import find_sound_source_files, load_json_lazy, save_json
+
+
+# batch_process_sound_sources에서 JSON을 동시에 읽을 최대 스레드 수
+_MAX_IO_WORKERS = 32
+
+# 프롬프트 템플릿 (str.format_map 으로 채움)
+_INSTRUMENT_TMPL = (
+    "Generate a high-fidelity, realistic sound effect.\n"
+    "The sound source is '{name}' made of '{material}'.\n"
+    "The action is a '{play_method}', creating a sound with a '{timbre_str}' timbre.\n"
+    "For this, use the sonic character of a '{instrument}' as an inspirational reference for the sound's quality, "
+    "especially its '{timbre_str}' aspects.\n"
+    "The final audio must be a completely natural sound, not a musical note."
+)
+
+_NO_INSTRUMENT_TMPL = (
+    "Generate a high-fidelity, realistic sound effect.\n"
+    "The sound source is '{name}' made of '{material}'.\n"
+    "The action is a '{play_method}', creating a sound with a '{timbre_str}' timbre.\n"
+    "The recording should be clean and detailed, sounding authentic as if captured in a real-world environment. "
+    "Focus on realism, not musicality."
+)
+
+# 소문자로 정규화한 mapping_to_music_instrument가 이 값들이면 악기 참조 없는 템플릿 사용
+_NO_INSTRUMENT = frozenset({"", "none"})
+
+_CONTEXT_PREFIX_TMPL = "Context: The scene is '{scene}'. The overall mood is '{mood}'.\n\n"
+
+_CONTEXT_SUFFIX_TMPL = "\n\nCrucially, the generated sound must be consistent with the '{mood}' mood and not feel out of place."
+
 
 def generate_prompts(data: dict, custom_templates: dict = None) -> List[Dict[str, Any]]:
     """VLM 출력 JSON을 AudioLDM2용 프롬프트로 변환"""
@@ -10,8 +41,16 @@ def generate_prompts(data: dict, custom_templates: dict = None) -> List[Dict[str
 
     scene = data.get("scene_description", "A neutral scene")
     mood = data.get("mood_description", "a neutral mood")
+
+    # scene/mood 문맥은 data 단위로 한 번만 만든다
+    scene_ctx = {"scene": scene, "mood": mood}
+    prefix = _CONTEXT_PREFIX_TMPL.format_map(scene_ctx)
+    suffix = _CONTEXT_SUFFIX_TMPL.format_map(scene_ctx)
     
-    generated_prompts = []
+    # 1차: 변형마다 문맥 dict를 만들고 적용할 템플릿 종류별로 인덱스 분류
+    custom_keys = frozenset(custom_templates)
+    entries = []
+    custom_items, instrument_items, plain_items = [], [], []
 
     for source in data.get("sound_sources", []):
         name = source.get("name", "an object")
@@ -19,56 +58,46 @@ def generate_prompts(data: dict, custom_templates: dict = None) -> List[Dict[str
 
         for variant in source.get("variants", []):
             play_method = variant.get("play_method")
-            timbre = variant.get("timbre", [])
             instrument = variant.get("mapping_to_music_instrument")
-            timbre_str = ", ".join(timbre)
-            
-            core_prompt = ""
-            
-            if play_method in custom_templates:
-                template = custom_templates[play_method]
-                core_prompt = template.format(
-                    name=name, material=material, play_method=play_method, 
-                    timbre_str=timbre_str, instrument=instrument
-                )
-            elif instrument and instrument.lower() != "none":
-                core_prompt = (
-                    f"Generate a high-fidelity, realistic sound effect.\n"
-                    f"The sound source is '{name}' made of '{material}'.\n"
-                    f"The action is a '{play_method}', creating a sound with a '{timbre_str}' timbre.\n"
-                    f"For this, use the sonic character of a '{instrument}' as an inspirational reference for the sound's quality, "
-                    f"especially its '{timbre_str}' aspects.\n"
-                    f"The final audio must be a completely natural sound, not a musical note."
-                )
-            else:
-                core_prompt = (
-                    f"Generate a high-fidelity, realistic sound effect.\n"
-                    f"The sound source is '{name}' made of '{material}'.\n"
-                    f"The action is a '{play_method}', creating a sound with a '{timbre_str}' timbre.\n"
-                    f"The recording should be clean and detailed, sounding authentic as if captured in a real-world environment. "
-                    f"Focus on realism, not musicality."
-                )
-
-            final_prompt = (
-                f"Context: The scene is '{scene}'. The overall mood is '{mood}'.\n\n"
-                f"{core_prompt}\n\n"
-                f"Crucially, the generated sound must be consistent with the '{mood}' mood and not feel out of place."
-            )
-            
-            generated_prompts.append({
-                "source_name": name,
+            ctx = {
+                "name": name,
+                "material": material,
                 "play_method": play_method,
-                "prompt": final_prompt
-            })
+                "timbre_str": ", ".join(variant.get("timbre", [])),
+                "instrument": instrument,
+            }
             
-    return generated_prompts
+            if play_method in custom_keys:
+                custom_items.append(len(entries))
+            elif (str(instrument).lower() if instrument else "") not in _NO_INSTRUMENT:
+                instrument_items.append(len(entries))
+            else:
+                plain_items.append(len(entries))
+            entries.append(ctx)
+
+    # 2차: 종류별로 고정된 템플릿을 분기 없이 적용 (원래 순서 유지)
+    core_prompts = [None] * len(entries)
+    for i in custom_items:
+        core_prompts[i] = custom_templates[entries[i]["play_method"]].format_map(entries[i])
+    for i in instrument_items:
+        core_prompts[i] = _INSTRUMENT_TMPL.format_map(entries[i])
+    for i in plain_items:
+        core_prompts[i] = _NO_INSTRUMENT_TMPL.format_map(entries[i])
+
+    return [
+        {
+            "source_name": ctx["name"],
+            "play_method": ctx["play_method"],
+            "prompt": "".join((prefix, core_prompt, suffix))
+        }
+        for ctx, core_prompt in zip(entries, core_prompts)
+    ]
 
 
 def process_sound_sources_json(json_path: str) -> List[Dict[str, Any]]:
     """JSON 파일을 읽어서 프롬프트 생성"""
     try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        data = load_json_lazy(json_path)
         
         prompts = generate_prompts(data)
         return prompts
@@ -86,24 +115,22 @@ def batch_process_sound_sources(sound_sources_dir: str = "sound_sources") -> Dic
         return results
     
     # 각 이미지별 폴더에서 JSON 파일 찾기
-    for image_folder in os.listdir(sound_sources_dir):
-        image_folder_path = os.path.join(sound_sources_dir, image_folder)
-        if not os.path.isdir(image_folder_path):
-            continue
-            
-        # 해당 폴더에서 JSON 파일 찾기
-        json_files = [f for f in os.listdir(image_folder_path) if f.endswith('_sound_source.json')]
-        
-        for json_file in json_files:
-            json_path = os.path.join(image_folder_path, json_file)
-            print(f"처리 중: {json_path}")
-            
-            prompts = process_sound_sources_json(json_path)
-            if prompts:
-                results[json_path] = prompts
-                print(f"  ✅ {len(prompts)}개 프롬프트 생성")
-            else:
-                print(f"  ❌ 프롬프트 생성 실패")
+    json_paths = find_sound_source_files(sound_sources_dir)
+
+    if not json_paths:
+        return results
+
+    # 작은 파일 다수를 읽는 I/O 대기 시간을 스레드 풀로 겹쳐서 처리
+    with ThreadPoolExecutor(max_workers=min(_MAX_IO_WORKERS, len(json_paths))) as pool:
+        all_prompts = list(pool.map(process_sound_sources_json, json_paths))
+
+    for json_path, prompts in zip(json_paths, all_prompts):
+        print(f"처리 중: {json_path}")
+        if prompts:
+            results[json_path] = prompts
+            print(f"  ✅ {len(prompts)}개 프롬프트 생성")
+        else:
+            print(f"  ❌ 프롬프트 생성 실패")
     
     return results
 
@@ -111,8 +138,7 @@ def batch_process_sound_sources(sound_sources_dir: str = "sound_sources") -> Dic
 def save_prompts_to_file(prompts: List[Dict[str, Any]], output_path: str) -> None:
     """생성된 프롬프트를 파일로 저장"""
     try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(prompts, f, ensure_ascii=False, indent=2)
+        save_json(prompts, output_path)
         print(f"프롬프트 저장 완료: {output_path}")
     except Exception as e:
         print(f"프롬프트 저장 중 오류 발생: {str(e)}")
@@ -1,50 +1,101 @@
 import os
-import json
-import glob
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Dict, Any, List
 
 import numpy as np
+import soundfile as sf
 import torch
 from diffusers import AudioLDMPipeline
-from scipy.io.wavfile import write as wav_write
 
 from audio_prompt import generate_prompts
-from utils import ensure_dir, sanitize_filename
-
-
-def _load_pipeline(model_id: str, hf_token: str | None) -> AudioLDMPipeline:
+from utils import (
+    ensure_dir,
+    sanitize_filename,
+    find_sound_source_files,
+    load_json_lazy,
+    positive_int,
+    save_json,
+    JSON_ARRAY_TYPES,
+)
+
+
+def _load_pipeline(model_id: str, hf_token: str | None, text_encoder_8bit: bool = False) -> AudioLDMPipeline:
     """AudioLDM2 파이프라인 로드"""
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+    if device == "cuda":
+        # Ampere 이상에서는 bf16 사용 (fp16과 속도는 같고 CLAP 텍스트 인코더 NaN 방지)
+        dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+    else:
+        dtype = torch.float32
     
     print(f"AudioLDM2 모델 로딩 중... (Device: {device}, Dtype: {dtype})")
+
+    extra_components = {}
+    if text_encoder_8bit and device == "cuda":
+        # 텍스트 인코더만 bitsandbytes int8로 로드 (비양자화 가중치도 UNet과 같은 dtype으로 맞춰 prompt_embeds dtype 불일치 방지)
+        from transformers import BitsAndBytesConfig, ClapTextModelWithProjection
+
+        extra_components["text_encoder"] = ClapTextModelWithProjection.from_pretrained(
+            model_id,
+            subfolder="text_encoder",
+            quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+            torch_dtype=dtype,
+            device_map={"": 0},
+            token=hf_token,
+        )
+        print("✅ 텍스트 인코더 int8 양자화 적용")
     
     pipe = AudioLDMPipeline.from_pretrained(
         model_id,
         torch_dtype=dtype,
         use_auth_token=hf_token,
+        **extra_components,
     )
     pipe = pipe.to(device)
+
+    if device == "cuda":
+        # 메모리 효율적인 attention (xformers 미설치 시 기본 attention 유지)
+        try:
+            pipe.enable_xformers_memory_efficient_attention()
+        except Exception:
+            pass
+        # UNet denoise 루프를 CUDA graph로 묶어 Python dispatch 오버헤드 감소
+        if hasattr(torch, "compile"):
+            pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=False)
+    # VAE 디코딩을 샘플 단위로 나눠 배치 생성 시 메모리 사용량 감소
+    pipe.vae.enable_slicing()
     
     print(f"✅ AudioLDM2 모델 로드 완료! Device: {pipe.device}")
     return pipe
 
 
+def _warmup_pipeline(pipe: AudioLDMPipeline, audio_seconds: float, guidance: float, batch_size: int) -> None:
+    """torch.compile 컴파일 비용을 첫 실제 프롬프트 전에 미리 지불"""
+    if pipe.device.type != "cuda":
+        return
+    print("🔥 파이프라인 워밍업 중...")
+    pipe(
+        ["warmup"] * batch_size,
+        num_inference_steps=2,
+        audio_length_in_s=audio_seconds,
+        guidance_scale=guidance,
+    )
+
+
 # _ensure_dir 함수는 utils.py의 ensure_dir로 대체됨
 
 
 def _load_json(path: str) -> Dict[str, Any]:
-    """JSON 파일 로드"""
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    """JSON 파일 로드 (generate_prompts가 읽는 필드만 지연 파싱)"""
+    return load_json_lazy(path)
 
 
 def _objects_to_sound_sources_if_needed(data: Dict[str, Any]) -> Dict[str, Any]:
     """objects를 sound_sources로 매핑 (호환성)"""
     if "sound_sources" in data:
         return data
-    if "objects" in data and isinstance(data["objects"], list):
+    if "objects" in data and isinstance(data["objects"], JSON_ARRAY_TYPES):
         return {
             **data,
             "sound_sources": data["objects"],
@@ -55,14 +106,18 @@ def _objects_to_sound_sources_if_needed(data: Dict[str, Any]) -> Dict[str, Any]:
 # _sanitize_filename 함수는 utils.py의 sanitize_filename으로 대체됨
 
 
-def _save_wav(path: str, audio: np.ndarray, sample_rate: int = 16000) -> None:
+def _save_wav(path: str, audio: np.ndarray | torch.Tensor, sample_rate: int = 16000) -> None:
     """오디오를 WAV 파일로 저장"""
-    # Ensure mono float32 in -1..1 -> int16
+    # 파이프라인 출력(np.ndarray)은 복사 없이 그대로 사용, 텐서 출력일 때만 CPU로 이동
+    if isinstance(audio, torch.Tensor):
+        audio = audio.detach().float().cpu().numpy()
+    else:
+        audio = np.asarray(audio)
+    # Ensure mono float32 in -1..1 -> PCM_16 (int16 변환은 libsndfile이 C에서 처리)
     if audio.ndim > 1:
-        audio = np.mean(audio, axis=0)
-    audio = np.clip(audio, -1.0, 1.0)
-    wav = (audio * 32767.0).astype(np.int16)
-    wav_write(path, sample_rate, wav)
+        audio = audio.mean(axis=0)
+    # libsndfile은 기본적으로 범위 밖 값을 clip하지 않으므로 한 번만 clip
+    sf.write(path, np.clip(audio, -1.0, 1.0), sample_rate, subtype="PCM_16")
 
 
 def generate_audio_for_sound_sources(
@@ -74,18 +129,23 @@ def generate_audio_for_sound_sources(
     guidance: float = 3.5,
     seed: int | None = None,
     single: str | None = None,
+    batch_size: int = 4,
+    text_encoder_8bit: bool = False,
 ) -> None:
     """Sound sources JSON 파일들을 처리하여 오디오 생성"""
+    if batch_size < 1:
+        raise ValueError(f"batch_size는 1 이상이어야 합니다: {batch_size}")
     
     ensure_dir(result_dir)
 
     hf_token = os.environ.get("HUGGING_FACE_TOKEN") or os.environ.get("HF_TOKEN")
-    pipe = _load_pipeline(model_id, hf_token)
+    pipe = _load_pipeline(model_id, hf_token, text_encoder_8bit=text_encoder_8bit)
+    _warmup_pipeline(pipe, audio_seconds, guidance, batch_size)
 
-    if seed is not None:
-        generator = torch.Generator(device=pipe.device).manual_seed(seed)
-    else:
-        generator = torch.Generator(device=pipe.device)
+    # 프롬프트마다 (base_seed + 이미지 내 순번) 시드의 generator를 사용해
+    # 배치 크기나 분할 방식과 관계없이 같은 프롬프트는 같은 결과를 재현
+    base_seed = seed if seed is not None else torch.Generator().seed()
+    print(f"🎲 Base seed: {base_seed}")
 
     # JSON 파일들 찾기
     if single:
@@ -100,13 +160,7 @@ def generate_audio_for_sound_sources(
         json_files = [candidate] if os.path.exists(candidate) else []
     else:
         # sound_sources 디렉토리의 모든 이미지 폴더에서 JSON 파일 찾기
-        json_files = []
-        for image_folder in os.listdir(sound_source_dir):
-            image_folder_path = os.path.join(sound_source_dir, image_folder)
-            if os.path.isdir(image_folder_path):
-                json_pattern = os.path.join(image_folder_path, "*_sound_source.json")
-                json_files.extend(glob.glob(json_pattern))
-        json_files = sorted(json_files)
+        json_files = find_sound_source_files(sound_source_dir)
     
     if not json_files:
         print(f"❌ JSON 파일을 찾을 수 없습니다: {sound_source_dir}")
@@ -114,11 +168,9 @@ def generate_audio_for_sound_sources(
 
     print(f"📁 {len(json_files)}개 JSON 파일 발견. 출력 -> {result_dir}")
 
-    total_audio_generated = 0
-    
+    # 1단계: 모든 JSON에서 프롬프트를 만들고 이미지별 결과 폴더를 미리 생성
+    jobs = []
     for json_path in json_files:
-        print(f"\n🎵 처리 중: {json_path}")
-        
         # 이미지 이름 추출 (폴더명 또는 파일명에서)
         if os.path.dirname(json_path) != sound_source_dir:
             # 하위 폴더에 있는 경우
@@ -130,51 +182,79 @@ def generate_audio_for_sound_sources(
         try:
             data = _objects_to_sound_sources_if_needed(_load_json(json_path))
             prompts: List[Dict[str, Any]] = generate_prompts(data)
+        except Exception as e:
+            print(f"  ❌ {json_path} 처리 중 오류: {str(e)}")
+            continue
             
-            if not prompts:
-                print(f"  ⚠️ {json_path}에서 프롬프트를 생성할 수 없습니다")
-                continue
-
-            # 이미지별 결과 폴더 생성
-            image_out_dir = os.path.join(result_dir, base)
-            ensure_dir(image_out_dir)
-
+        if not prompts:
+            print(f"  ⚠️ {json_path}에서 프롬프트를 생성할 수 없습니다")
+            continue
+
+        image_out_dir = os.path.join(result_dir, base)
+        ensure_dir(image_out_dir)
+        jobs.append((json_path, image_out_dir, prompts))
+
+    # 2단계: 오디오 생성 (WAV 저장은 저장 스레드에 맡기고 바로 다음 배치 생성)
+    save_futures = []
+    with ThreadPoolExecutor(max_workers=2) as writer_pool:
+        for json_path, image_out_dir, prompts in jobs:
+            print(f"\n🎵 처리 중: {json_path}")
             print(f"  🎯 {len(prompts)}개 오디오 클립 생성 중...")
-            
-            for idx, item in enumerate(prompts, 1):
-                prompt_text = item["prompt"]
-                source_name = sanitize_filename(item.get("source_name", "source"))
-                play_method = sanitize_filename(str(item.get("play_method", "act")))
-
-                out_name = f"{idx:02d}_{source_name}_{play_method}.wav"
-                out_path = os.path.join(image_out_dir, out_name)
-
-                try:
-                    with torch.autocast(device_type=("cuda" if torch.cuda.is_available() else "cpu")):
-                        audio = pipe(
-                            prompt_text,
+
+            try:
+                # 출력 파일명은 생성 루프 전에 한 번에 계산
+                all_out_names = [
+                    f"{idx:02d}_{sanitize_filename(item.get('source_name', 'source'))}"
+                    f"_{sanitize_filename(str(item.get('play_method', 'act')))}.wav"
+                    for idx, item in enumerate(prompts, 1)
+                ]
+
+                # GPU 메모리에 맞춰 batch_size개씩 묶어 한 번의 pipe() 호출로 생성
+                for start in range(0, len(prompts), batch_size):
+                    batch = prompts[start:start + batch_size]
+                    out_names = all_out_names[start:start + batch_size]
+                    generators = [
+                        torch.Generator(device=pipe.device).manual_seed(base_seed + i)
+                        for i in range(start, start + len(batch))
+                    ]
+
+                    try:
+                        # 파이프라인이 이미 로드 시 dtype으로 올라가 있으므로 autocast 없이 호출
+                        audios = pipe(
+                            [item["prompt"] for item in batch],
                             num_inference_steps=steps,
                             audio_length_in_s=audio_seconds,
                             guidance_scale=guidance,
-                            generator=generator,
-                        ).audios[0]
-
-                    _save_wav(out_path, np.array(audio), sample_rate=16000)
-                    print(f"    ✅ {out_name}")
-                    total_audio_generated += 1
-                    
-                except Exception as e:
-                    print(f"    ❌ {out_name} 생성 실패: {str(e)}")
-            
-            # 사용된 프롬프트들을 추적용으로 저장
-            prompts_dump = os.path.join(image_out_dir, "prompts.json")
-            with open(prompts_dump, "w", encoding="utf-8") as f:
-                json.dump(prompts, f, ensure_ascii=False, indent=2)
-            
-            print(f"  📄 프롬프트 저장: {prompts_dump}")
-            
-        except Exception as e:
-            print(f"  ❌ {json_path} 처리 중 오류: {str(e)}")
+                            generator=generators,
+                            num_waveforms_per_prompt=1,
+                        ).audios
+                    except Exception as e:
+                        for out_name in out_names:
+                            print(f"    ❌ {out_name} 생성 실패: {str(e)}")
+                        continue
+
+                    for out_name, audio in zip(out_names, audios):
+                        out_path = os.path.join(image_out_dir, out_name)
+                        save_futures.append(
+                            (out_name, writer_pool.submit(_save_wav, out_path, audio, 16000))
+                        )
+                        print(f"    ✅ {out_name}")
+                
+                # 사용된 프롬프트들을 추적용으로 저장
+                prompts_dump = os.path.join(image_out_dir, "prompts.json")
+                save_json(prompts, prompts_dump)
+                
+                print(f"  📄 프롬프트 저장: {prompts_dump}")
+                
+            except Exception as e:
+                print(f"  ❌ {json_path} 처리 중 오류: {str(e)}")
+
+    total_audio_generated = 0
+    for out_name, future in save_futures:
+        if future.exception() is not None:
+            print(f"    ❌ {out_name} 저장 실패: {str(future.exception())}")
+        else:
+            total_audio_generated += 1
     
     print(f"\n🎉 오디오 생성 완료!")
     print(f"📊 총 {total_audio_generated}개 오디오 파일 생성")
@@ -190,6 +270,8 @@ def run_generation(
     guidance: float = 3.5,
     seed: int | None = None,
     single: str | None = None,
+    batch_size: int = 4,
+    text_encoder_8bit: bool = False,
 ) -> None:
     """오디오 생성 실행"""
     try:
@@ -202,6 +284,8 @@ def run_generation(
             guidance=guidance,
             seed=seed,
             single=single,
+            batch_size=batch_size,
+            text_encoder_8bit=text_encoder_8bit,
         )
     except Exception as e:
         print(f"❌ 오디오 생성 중 오류 발생: {str(e)}")
@@ -221,6 +305,8 @@ if __name__ == "__main__":
     parser.add_argument("--guidance", type=float, default=3.5, help="Guidance scale")
     parser.add_argument("--seed", type=int, default=None, help="랜덤 시드")
     parser.add_argument("--single", type=str, default=None, help="단일 샘플: 이미지 이름 (예: 101) 또는 JSON 파일 경로")
+    parser.add_argument("--batch_size", type=positive_int, default=4, help="한 번의 pipe() 호출로 생성할 프롬프트 수 (GPU 메모리에 맞게 조정)")
+    parser.add_argument("--text_encoder_8bit", action="store_true", help="텍스트 인코더를 int8로 양자화 (bitsandbytes 필요)")
     
     args = parser.parse_args()
 
@@ -238,4 +324,6 @@ if __name__ == "__main__":
         guidance=args.guidance,
         seed=args.seed,
         single=args.single,
+        batch_size=args.batch_size,
+        text_encoder_8bit=args.text_encoder_8bit,
     )
@@ -1,13 +1,42 @@
 import os
-import json
 import glob
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import traceback
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
-from vlm_qwen import load_qwen_vl, process_image_with_vlm
+from vlm_qwen import (
+    build_generation_kwargs,
+    load_qwen_vl,
+    prepare_image,
+    process_image_with_vlm,
+    process_images_with_vlm_batch,
+)
 from vlm_prompt.extract_sources import get_scene_to_sound_prompt
-from utils import find_image_files, ensure_dir
+from utils import find_image_files, ensure_dir, positive_int, save_json
+
+
+@functools.lru_cache(maxsize=1)
+def _get_vlm(quantize: Optional[str] = None):
+    """VLM 모델과 프로세서를 프로세스당 한 번만 로드 (quantize: None / '4bit' / '8bit')"""
+    print("VLM 모델 로딩 중...")
+    model, processor = load_qwen_vl(quantize=quantize)
+    print(f"✅ VLM 모델 로드 완료! Device: {model.device}")
+    return model, processor
+
+
+# batch_process_images에서 미리 디코딩/전처리해 둘 이미지 수
+_PREFETCH_IMAGES = 2
+
+
+def _prepare_image(processor, image_path: str):
+    """로더 스레드에서 디코딩 + 프로세서 전처리까지 수행 (실패 시 None -> VLM 단계에서 오류 처리)"""
+    try:
+        return prepare_image(processor, image_path)
+    except Exception:
+        return None
 
 
 def find_images_in_data_folder(data_dir: str = "data") -> List[str]:
@@ -20,25 +49,18 @@ def find_images_in_data_folder(data_dir: str = "data") -> List[str]:
     return image_files
 
 
-def process_single_image(model, processor, image_path: str, output_dir: str, prompt: str, example_images: List) -> Dict[str, Any]:
-    """단일 이미지를 처리하여 sound source JSON 생성"""
-    print(f"\n처리 중: {os.path.basename(image_path)}")
-    
+def _build_result(image_path: str, output_dir: str, parsed: Dict[str, Any], save_fn=save_json) -> Dict[str, Any]:
+    """VLM 파싱 결과를 검증하고 sound source JSON을 저장한 뒤 결과 dict 생성"""
     base_name = os.path.splitext(os.path.basename(image_path))[0]
     
+    result = {
+        "image_path": image_path,
+        "filename": base_name,
+        "success": parsed['success'],
+        "timestamp": datetime.now().isoformat()
+    }
+    
     try:
-        print("JSON 생성 중...")
-        
-        # VLM을 사용하여 이미지 처리
-        parsed = process_image_with_vlm(model, processor, image_path, prompt, example_images)
-        
-        result = {
-            "image_path": image_path,
-            "filename": base_name,
-            "success": parsed['success'],
-            "timestamp": datetime.now().isoformat()
-        }
-        
         if parsed['success']:
             json_data = parsed['json_data']
             
@@ -64,8 +86,7 @@ def process_single_image(model, processor, image_path: str, output_dir: str, pro
             json_filename = f"{base_name}_sound_source.json"
             json_path = os.path.join(image_output_dir, json_filename)
             
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(json_data, f, indent=2, ensure_ascii=False)
+            save_fn(json_data, json_path)
             
             result["output_json_path"] = json_path
             
@@ -78,8 +99,10 @@ def process_single_image(model, processor, image_path: str, output_dir: str, pro
         else:
             result.update({
                 "error": parsed['error'],
-                "raw_response": parsed['raw_response']
+                "raw_response": parsed.get('raw_response')
             })
+            if 'traceback' in parsed:
+                result["traceback"] = parsed['traceback']
             print(f"❌ 실패: {parsed['error']}")
             
     except Exception as e:
@@ -93,6 +116,55 @@ def process_single_image(model, processor, image_path: str, output_dir: str, pro
     return result
 
 
+def _processing_error(e: Exception) -> Dict[str, Any]:
+    """VLM 호출 중 발생한 예외를 실패한 파싱 결과 형태로 변환"""
+    print(f"💥 오류: {str(e)}")
+    return {
+        "success": False,
+        "error": f"Processing error: {str(e)}",
+        "traceback": traceback.format_exc()
+    }
+
+
+def process_single_image(model, processor, image_path: str, output_dir: str, prompt: str, example_images: List,
+                         save_fn=save_json, static_cache: bool = False, prepared=None,
+                         generation_kwargs=None) -> Dict[str, Any]:
+    """단일 이미지를 처리하여 sound source JSON 생성"""
+    print(f"\n처리 중: {os.path.basename(image_path)}")
+    
+    try:
+        print("JSON 생성 중...")
+        
+        # VLM을 사용하여 이미지 처리
+        parsed = process_image_with_vlm(model, processor, image_path, prompt, example_images,
+                                        static_cache=static_cache, prepared=prepared,
+                                        generation_kwargs=generation_kwargs)
+    except Exception as e:
+        parsed = _processing_error(e)
+    
+    return _build_result(image_path, output_dir, parsed, save_fn)
+
+
+def process_image_batch(model, processor, image_paths: List[str], output_dir: str, prompt: str, example_images: List,
+                        save_fn=save_json, static_cache: bool = False,
+                        prepared=None, generation_kwargs=None) -> List[Dict[str, Any]]:
+    """여러 이미지를 한 번의 model.generate로 처리하여 sound source JSON 생성"""
+    try:
+        print("\nJSON 배치 생성 중...")
+        parsed_list = process_images_with_vlm_batch(model, processor, image_paths, prompt, example_images,
+                                                    batch_size=len(image_paths),
+                                                    static_cache=static_cache, prepared=prepared,
+                                                    generation_kwargs=generation_kwargs)
+    except Exception as e:
+        parsed_list = [_processing_error(e)] * len(image_paths)
+    
+    results = []
+    for image_path, parsed in zip(image_paths, parsed_list):
+        print(f"\n처리 중: {os.path.basename(image_path)}")
+        results.append(_build_result(image_path, output_dir, parsed, save_fn))
+    return results
+
+
 def count_total_variants(json_data: Dict[str, Any]) -> int:
     """JSON 데이터에서 총 variants 수 계산"""
     if not isinstance(json_data, dict):
@@ -133,8 +205,11 @@ def validate_json_structure(json_data: Dict[str, Any]) -> List[str]:
     return issues
 
 
-def batch_process_images(data_dir: str = "data", output_dir: str = "sound_sources") -> Dict[str, Any]:
+def batch_process_images(data_dir: str = "data", output_dir: str = "sound_sources", vlm_batch_size: int = 1,
+                         vlm_quantize: Optional[str] = None, vlm_temperature: float = 0.0) -> Dict[str, Any]:
     """data 폴더의 모든 이미지를 배치 처리"""
+    if vlm_batch_size < 1:
+        raise ValueError(f"vlm_batch_size는 1 이상이어야 합니다: {vlm_batch_size}")
     print("🚀 배치 Sound Source 생성 시작")
     print("=" * 80)
 
@@ -142,9 +217,8 @@ def batch_process_images(data_dir: str = "data", output_dir: str = "sound_source
     print(f"출력 디렉토리: {output_dir}")
     
     # VLM 모델 로드
-    print("VLM 모델 로딩 중...")
-    model, processor = load_qwen_vl()
-    print(f"✅ VLM 모델 로드 완료! Device: {model.device}")
+    model, processor = _get_vlm(vlm_quantize)
+    gen_kwargs = build_generation_kwargs(vlm_temperature)
     
     # 프롬프트 및 예시 데이터 로드
     prompt, example_images = get_scene_to_sound_prompt()
@@ -173,11 +247,58 @@ def batch_process_images(data_dir: str = "data", output_dir: str = "sound_source
     print("이미지 처리 시작")
     print("=" * 80)
     
-    for i, image_path in enumerate(image_files, 1):
-        print(f"\n[{i}/{len(image_files)}]", end="")
-        
-        result = process_single_image(model, processor, image_path, output_dir, prompt, example_images)
-        all_results.append(result)
+    # 로더 스레드: 다음 이미지 디코딩 + 전처리 / 저장 스레드: JSON 저장 -> GPU 추론과 겹쳐서 실행
+    write_futures = []
+    with ThreadPoolExecutor(max_workers=_PREFETCH_IMAGES) as loader, ThreadPoolExecutor(max_workers=1) as writer:
+        def save_async(obj, path):
+            write_futures.append((path, writer.submit(save_json, obj, path)))
+
+        prefetch = max(_PREFETCH_IMAGES, vlm_batch_size)
+        pending = deque(loader.submit(_prepare_image, processor, path) for path in image_files[:prefetch])
+        next_index = len(pending)
+
+        # vlm_batch_size개씩 묶어 처리 (1이면 이미지별 개별 생성)
+        for start in range(0, len(image_files), vlm_batch_size):
+            chunk = image_files[start:start + vlm_batch_size]
+
+            prepared = []
+            for _ in chunk:
+                prepared.append(pending.popleft().result())
+                if next_index < len(image_files):
+                    pending.append(loader.submit(_prepare_image, processor, image_files[next_index]))
+                    next_index += 1
+            
+            # 프리픽스 KV cache를 쓰지 않는 경로(예시 없음/배치)에서만 고정 shape KV cache 사용
+            if len(chunk) == 1:
+                print(f"\n[{start + 1}/{len(image_files)}]", end="")
+                chunk_results = [process_single_image(model, processor, chunk[0], output_dir, prompt, example_images,
+                                                       save_fn=save_async, static_cache=True,
+                                                       prepared=prepared[0], generation_kwargs=gen_kwargs)]
+            else:
+                print(f"\n[{start + 1}-{start + len(chunk)}/{len(image_files)}]", end="")
+                chunk_results = process_image_batch(model, processor, chunk, output_dir, prompt, example_images,
+                                                    save_fn=save_async, static_cache=True, prepared=prepared,
+                                                    generation_kwargs=gen_kwargs)
+
+            all_results.extend(chunk_results)
+
+    # 저장이 끝난 뒤에 성공 여부를 확정 (저장 실패한 결과는 실패로 처리)
+    write_errors = {}
+    for json_path, future in write_futures:
+        error = future.exception()
+        if error is not None:
+            write_errors[json_path] = error
+            print(f"❌ JSON 저장 실패: {json_path}: {error}")
+    
+    for result in all_results:
+        error = write_errors.get(result.get('output_json_path'))
+        if error is not None:
+            del result['output_json_path']
+            result.update({
+                "success": False,
+                "error": f"Processing error: {str(error)}",
+                "traceback": "".join(traceback.format_exception(type(error), error, error.__traceback__))
+            })
         
         if result['success']:
             successful_results.append(result)
@@ -199,8 +320,7 @@ def batch_process_images(data_dir: str = "data", output_dir: str = "sound_source
     }
     
     summary_path = os.path.join(output_dir, "processing_summary.json")
-    with open(summary_path, 'w', encoding='utf-8') as f:
-        json.dump(summary, f, indent=2, ensure_ascii=False)
+    save_json(summary, summary_path)
     
     # 최종 리포트 출력
     print("\n" + "=" * 80)
@@ -237,20 +357,20 @@ def batch_process_images(data_dir: str = "data", output_dir: str = "sound_source
     }
 
 
-def process_single_image_with_vlm(image_path: str, output_dir: str) -> Dict[str, Any]:
+def process_single_image_with_vlm(image_path: str, output_dir: str, vlm_quantize: Optional[str] = None,
+                                  vlm_temperature: float = 0.0) -> Dict[str, Any]:
     """단일 이미지를 VLM으로 처리하는 고수준 함수"""
     try:
-        # VLM 모델 로드
-        print("VLM 모델 로딩 중...")
-        model, processor = load_qwen_vl()
-        print(f"✅ VLM 모델 로드 완료! Device: {model.device}")
+        # VLM 모델 로드 (프로세스 내 재호출 시 캐시 사용)
+        model, processor = _get_vlm(vlm_quantize)
         
         # 프롬프트 및 예시 데이터 로드
         prompt, example_images = get_scene_to_sound_prompt()
         print(f"✅ 프롬프트 로드 완료! 예시 이미지: {len(example_images)}개")
         
         # 단일 이미지 처리
-        result = process_single_image(model, processor, image_path, output_dir, prompt, example_images)
+        result = process_single_image(model, processor, image_path, output_dir, prompt, example_images,
+                                      generation_kwargs=build_generation_kwargs(vlm_temperature))
         return result
         
     except Exception as e:
@@ -264,10 +384,12 @@ def process_single_image_with_vlm(image_path: str, output_dir: str) -> Dict[str,
         }
 
 
-def run_batch_processing():
+def run_batch_processing(data_dir: str = "data", output_dir: str = "sound_sources", vlm_batch_size: int = 1,
+                         vlm_quantize: Optional[str] = None, vlm_temperature: float = 0.0):
     """배치 처리 실행"""
     try:
-        results = batch_process_images()
+        results = batch_process_images(data_dir, output_dir, vlm_batch_size=vlm_batch_size, vlm_quantize=vlm_quantize,
+                                       vlm_temperature=vlm_temperature)
         return results
     except Exception as e:
         print(f"❌ 배치 처리 중 오류 발생: {str(e)}")
@@ -283,6 +405,10 @@ if __name__ == "__main__":
     parser.add_argument("--single", type=str, default=None, help="단일 이미지 경로 (예: data/101.jpg)")
     parser.add_argument("--out", type=str, default="sound_sources", help="출력 디렉토리")
     parser.add_argument("--data", type=str, default="data", help="입력 데이터 디렉토리")
+    parser.add_argument("--batch_size", type=positive_int, default=1, help="한 번의 model.generate로 처리할 이미지 수")
+    parser.add_argument("--quantize", type=str, default=None, choices=["4bit", "8bit"],
+                        help="VLM 언어 모델을 bitsandbytes로 양자화 (비전 타워는 원래 dtype 유지)")
+    parser.add_argument("--temperature", type=float, default=0.0, help="0이면 greedy, 0보다 크면 top_p=0.8 샘플링")
     args = parser.parse_args()
 
     print("🚀 Sound Source 생성기")
@@ -292,7 +418,8 @@ if __name__ == "__main__":
         print("모드: 단일 이미지 처리")
         ensure_dir(args.out)
         
-        res = process_single_image_with_vlm(args.single, args.out)
+        res = process_single_image_with_vlm(args.single, args.out, vlm_quantize=args.quantize,
+                                            vlm_temperature=args.temperature)
         if res.get("success"):
             print("\n🎉 단일 처리 완료!")
             print(f"JSON: {res.get('output_json_path')}")
@@ -301,7 +428,8 @@ if __name__ == "__main__":
     else:
         print("모드: 배치 처리")
         # 배치 처리 실행
-        results = run_batch_processing()
+        results = run_batch_processing(args.data, args.out, vlm_batch_size=args.batch_size, vlm_quantize=args.quantize,
+                                       vlm_temperature=args.temperature)
         if results:
             print("\n🎉 배치 처리 완료!")
             print("생성된 파일들을 'sound_sources' 디렉토리에서 확인하세요.")
@@ -5,14 +5,13 @@ Scene-to-Sound Generation Pipeline
 """
 
 import os
-import json
 import argparse
 from datetime import datetime
 from typing import Dict, Any, Optional
 
 from image_to_text import batch_process_images, process_single_image_with_vlm
 from audioldm2 import run_generation as generate_audio
-from utils import check_required_directories, check_required_files, ensure_dir
+from utils import check_required_directories, check_required_files, ensure_dir, iter_files, positive_int, save_json
 
 
 def print_banner():
@@ -79,7 +78,11 @@ def run_full_pipeline(
     audio_seconds: float = 4.0,
     audio_steps: int = 200,
     audio_guidance: float = 3.5,
-    audio_seed: Optional[int] = None
+    audio_seed: Optional[int] = None,
+    audio_batch_size: int = 4,
+    vlm_batch_size: int = 1,
+    vlm_quantize: Optional[str] = None,
+    vlm_temperature: float = 0.0
 ) -> Dict[str, Any]:
     """전체 파이프라인 실행"""
     
@@ -105,7 +108,8 @@ def run_full_pipeline(
             if single_image:
                 # 단일 이미지 처리
                 print(f"단일 이미지 처리: {single_image}")
-                result = process_single_image_with_vlm(single_image, sound_sources_dir)
+                result = process_single_image_with_vlm(single_image, sound_sources_dir, vlm_quantize=vlm_quantize,
+                                                       vlm_temperature=vlm_temperature)
                 
                 if result.get("success"):
                     print(f"✅ 단일 이미지 처리 완료: {result.get('output_json_path')}")
@@ -115,7 +119,8 @@ def run_full_pipeline(
                     results["errors"].append(f"VLM 단일 처리 실패: {result.get('error')}")
             else:
                 # 배치 처리
-                vlm_results = batch_process_images(data_dir, sound_sources_dir)
+                vlm_results = batch_process_images(data_dir, sound_sources_dir, vlm_batch_size=vlm_batch_size,
+                                                   vlm_quantize=vlm_quantize, vlm_temperature=vlm_temperature)
                 
                 if vlm_results and not vlm_results.get("error"):
                     successful = len(vlm_results.get("successful_results", []))
@@ -135,10 +140,10 @@ def run_full_pipeline(
         
         sound_source_files = []
         if os.path.exists(sound_sources_dir):
-            for root, dirs, files in os.walk(sound_sources_dir):
-                for file in files:
-                    if file.endswith('_sound_source.json'):
-                        sound_source_files.append(os.path.join(root, file))
+            sound_source_files = [
+                entry.path for entry in iter_files(sound_sources_dir)
+                if entry.name.endswith('_sound_source.json')
+            ]
         
         if not sound_source_files:
             print("❌ Sound Sources JSON 파일을 찾을 수 없습니다")
@@ -161,7 +166,8 @@ def run_full_pipeline(
                     steps=audio_steps,
                     guidance=audio_guidance,
                     seed=audio_seed,
-                    single=single_image
+                    single=single_image,
+                    batch_size=audio_batch_size
                 )
                 print("✅ 오디오 생성 완료")
                 results["steps_completed"].append("audio_generation")
@@ -216,12 +222,19 @@ def main():
     parser.add_argument("--skip_vlm", action="store_true", help="VLM 단계 건너뛰기")
     parser.add_argument("--skip_audio", action="store_true", help="오디오 생성 단계 건너뛰기")
     
+    # VLM 설정
+    parser.add_argument("--vlm_batch_size", type=positive_int, default=1, help="한 번에 VLM으로 처리할 이미지 수")
+    parser.add_argument("--vlm_quantize", type=str, default=None, choices=["4bit", "8bit"],
+                        help="VLM 언어 모델 bitsandbytes 양자화")
+    parser.add_argument("--vlm_temperature", type=float, default=0.0, help="VLM 샘플링 온도 (0이면 greedy)")
+    
     # 오디오 생성 설정
     parser.add_argument("--audio_model", type=str, default="cvssp/audioldm-s-full-v2", help="AudioLDM 모델 ID")
     parser.add_argument("--audio_seconds", type=float, default=4.0, help="오디오 길이 (초)")
     parser.add_argument("--audio_steps", type=int, default=200, help="Diffusion 스텝 수")
     parser.add_argument("--audio_guidance", type=float, default=3.5, help="Guidance scale")
     parser.add_argument("--audio_seed", type=int, default=None, help="랜덤 시드")
+    parser.add_argument("--audio_batch_size", type=positive_int, default=4, help="한 번에 생성할 오디오 프롬프트 수")
     
     # 결과 저장
     parser.add_argument("--save_log", type=str, default=None, help="실행 로그 저장 파일")
@@ -246,13 +259,16 @@ def main():
         audio_seconds=args.audio_seconds,
         audio_steps=args.audio_steps,
         audio_guidance=args.audio_guidance,
-        audio_seed=args.audio_seed
+        audio_seed=args.audio_seed,
+        audio_batch_size=args.audio_batch_size,
+        vlm_batch_size=args.vlm_batch_size,
+        vlm_quantize=args.vlm_quantize,
+        vlm_temperature=args.vlm_temperature
     )
     
     # 로그 저장
     if args.save_log:
-        with open(args.save_log, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
+        save_json(results, args.save_log)
         print(f"📄 실행 로그 저장: {args.save_log}")
 
 
@@ -4,61 +4,194 @@
 """
 
 import os
-from typing import List
+import json
+import time
+import argparse
+import functools
+from typing import Any, Iterator, List, Tuple
+
+try:
+    import orjson
+except ImportError:  # orjson 미설치 시 표준 json으로 대체
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:  # simdjson 미설치 시 load_json으로 대체
+    simdjson = None
+
+# load_json_lazy 결과에서 JSON 배열로 취급할 타입들
+JSON_ARRAY_TYPES = (list, simdjson.Array) if simdjson is not None else (list,)
+
+
+# ensure_dir로 이미 생성/확인한 디렉토리 (같은 경로는 다시 stat/mkdir 하지 않음)
+_EXISTING_DIRS = set()
 
 
 def ensure_dir(path: str) -> None:
     """디렉토리가 존재하지 않으면 생성"""
+    if path in _EXISTING_DIRS:
+        return
     os.makedirs(path, exist_ok=True)
+    _EXISTING_DIRS.add(path)
+
+
+_DEFAULT_IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.bmp'})
+
+
+def iter_files(directory: str) -> Iterator[os.DirEntry]:
+    """디렉토리를 재귀적으로 탐색하며 파일 DirEntry들을 반환 (os.walk보다 stat 호출이 적음)"""
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    # 디렉토리 심볼릭 링크는 따라가지 않고(os.walk 기본값과 동일), 파일 링크는 포함
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry
+        except OSError:
+            continue
 
 
 def find_image_files(directory: str, valid_extensions: set = None) -> List[str]:
-    """디렉토리에서 이미지 파일들을 찾아 반환"""
+    """디렉토리에서 이미지 파일들을 찾아 반환 (확장자는 대소문자 구분 없음)"""
     if valid_extensions is None:
-        valid_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.JPG', '.JPEG', '.PNG', '.BMP'}
+        valid_extensions = _DEFAULT_IMAGE_EXTENSIONS
+    else:
+        valid_extensions = frozenset(ext.lower() for ext in valid_extensions)
+    
+    # 디렉토리 내용이 바뀔 수 있으므로 1분 단위로만 캐시 (즉시 갱신이 필요하면 find_image_files.cache_clear())
+    return list(_find_image_files_cached(directory, valid_extensions, int(time.time() // 60)))
+
+
+@functools.lru_cache(maxsize=4)
+def _find_image_files_cached(directory: str, valid_extensions: frozenset, epoch_minute: int) -> Tuple[str, ...]:
+    """find_image_files의 실제 탐색 (epoch_minute는 캐시 만료용 키)"""
+    if not os.path.exists(directory):
+        return ()
     
     image_files = []
+    for entry in iter_files(directory):
+        _, dot, ext = entry.name.rpartition('.')
+        if dot and '.' + ext.lower() in valid_extensions:
+            image_files.append(entry.path)
     
+    return tuple(sorted(image_files))
+
+
+find_image_files.cache_clear = _find_image_files_cached.cache_clear
+
+
+def find_sound_source_files(directory: str, suffix: str = "_sound_source.json") -> List[str]:
+    """이미지별 하위 폴더에서 sound source JSON 파일들을 찾아 반환"""
+    json_files = []
+
     if not os.path.exists(directory):
-        return image_files
+        return json_files
+
+    # scandir의 DirEntry는 디렉토리 읽기 결과에 타입 정보를 담고 있어 항목별 stat이 필요 없다
+    with os.scandir(directory) as folders:
+        for folder in folders:
+            if not folder.is_dir():
+                continue
+            with os.scandir(folder.path) as entries:
+                json_files.extend(entry.path for entry in entries if entry.name.endswith(suffix))
+
+    return sorted(json_files)
+
+
+def _find_missing_paths(paths: List[str]) -> List[str]:
+    """경로들을 부모 디렉토리별로 묶어 디렉토리당 scandir 한 번으로 존재 여부 확인"""
+    names_by_parent = {}
+    for path in paths:
+        parent, name = os.path.split(os.path.normpath(path))
+        if name not in ('', os.curdir, os.pardir):
+            names_by_parent.setdefault(parent or os.curdir, set()).add(name)
     
-    for root_dir, _, files in os.walk(directory):
-        for name in files:
-            base, ext = os.path.splitext(name)
-            if ext in valid_extensions:
-                image_files.append(os.path.join(root_dir, name))
+    existing = {}
+    for parent in names_by_parent:
+        try:
+            with os.scandir(parent) as entries:
+                # 심볼릭 링크는 대상이 있는지 별도 확인이 필요하므로 목록에서 제외
+                existing[parent] = {entry.name for entry in entries if not entry.is_symlink()}
+        except OSError:
+            existing[parent] = set()
     
-    return sorted(image_files)
+    missing = []
+    for path in paths:
+        parent, name = os.path.split(os.path.normpath(path))
+        if name in ('', os.curdir, os.pardir) or name not in existing[parent or os.curdir]:
+            # 목록에 없는 이름('.', 루트, 링크, 대소문자 구분 없는 파일시스템의 다른 표기 등)은 직접 확인
+            if not os.path.exists(path):
+                missing.append(path)
+    return missing
 
 
 def check_required_directories(required_dirs: List[str]) -> List[str]:
     """필수 디렉토리들이 존재하는지 확인하고 누락된 것들을 반환"""
-    missing_dirs = []
-    
-    for dir_name in required_dirs:
-        if not os.path.exists(dir_name):
-            missing_dirs.append(dir_name)
-    
-    return missing_dirs
+    return _find_missing_paths(required_dirs)
 
 
 def check_required_files(required_files: List[str]) -> List[str]:
     """필수 파일들이 존재하는지 확인하고 누락된 것들을 반환"""
-    missing_files = []
-    
-    for file_path in required_files:
-        if not os.path.exists(file_path):
-            missing_files.append(file_path)
-    
-    return missing_files
+    return _find_missing_paths(required_files)
+
+
+# 파일명에 사용할 수 없는 문자 -> '_' 변환 테이블 (str.translate 한 번으로 처리)
+_FILENAME_TRANS = str.maketrans('<>:"/\\|?*', '_' * 9)
 
 
 def sanitize_filename(text: str, max_length: int = 120) -> str:
     """파일명에 사용할 수 없는 문자를 제거하고 길이를 제한"""
-    invalid_chars = '<>:"/\\|?*'
-    for char in invalid_chars:
-        text = text.replace(char, "_")
-    
     # 공백을 언더스코어로 변경하고 길이 제한
-    text = "_".join(text.split())[:max_length]
-    return text
+    return "_".join(text.translate(_FILENAME_TRANS).split())[:max_length]
+
+
+def load_json(path: str) -> Any:
+    """JSON 파일 로드 (orjson 사용 가능 시 bytes로 바로 파싱)"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_json_lazy(path: str) -> Any:
+    """일부 필드만 읽는 용도의 JSON 로드 (simdjson 사용 가능 시 읽기 전용 지연 프록시 반환)"""
+    if simdjson is None:
+        return load_json(path)
+    with open(path, 'rb') as f:
+        # 파서는 살아 있는 문서가 있으면 재사용할 수 없으므로 호출마다 새로 생성
+        return simdjson.Parser().parse(f.read())
+
+
+def _json_default(obj: Any) -> Any:
+    """표준 json 대체 경로용 변환 (numpy 값/배열, datetime)"""
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def save_json(obj: Any, path: str) -> None:
+    """JSON 파일 저장 (들여쓰기 2칸, 유니코드 그대로 유지, numpy 값 지원)"""
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(
+                obj,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+            ))
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2, default=_json_default)
+
+
+def positive_int(value: str) -> int:
+    """argparse type: 1 이상의 정수만 허용 (배치 크기 등)"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"1 이상의 정수여야 합니다: {value}")
+    return number
@@ -1,32 +1,35 @@
+import functools
 import json
 import os
 
+from PIL import Image
+
+from utils import load_json
+
+@functools.lru_cache(maxsize=1)
 def load_example_data():
-    """vlm_prompt 폴더에서 예시 데이터를 로드"""
+    """vlm_prompt 폴더에서 예시 데이터를 로드 (디코딩된 PIL 이미지, JSON 문자열) 튜플들을 반환"""
     example_images = []
     
-    # 111번 예시
+    # 111번 예시 (JSON 문자열은 VLM 입력이므로 stdlib json.dumps 형식 그대로 유지)
     ex1_img = os.path.join("vlm_prompt", "image", "111.jpg")
     ex1_json_path = os.path.join("vlm_prompt", "111_sound_source.json")
     if os.path.exists(ex1_img) and os.path.exists(ex1_json_path):
-        with open(ex1_json_path, 'r', encoding='utf-8') as f:
-            ex1_json = json.load(f)
-        example_images.append((ex1_img, json.dumps(ex1_json, ensure_ascii=False)))
+        ex1_json = load_json(ex1_json_path)
+        example_images.append((Image.open(ex1_img).convert('RGB'), json.dumps(ex1_json, ensure_ascii=False)))
     
     # 211번 예시
     ex2_img = os.path.join("vlm_prompt", "image", "211.jpg")
     ex2_json_path = os.path.join("vlm_prompt", "211_sound_source.json")
     if os.path.exists(ex2_img) and os.path.exists(ex2_json_path):
-        with open(ex2_json_path, 'r', encoding='utf-8') as f:
-            ex2_json = json.load(f)
-        example_images.append((ex2_img, json.dumps(ex2_json, ensure_ascii=False)))
+        ex2_json = load_json(ex2_json_path)
+        example_images.append((Image.open(ex2_img).convert('RGB'), json.dumps(ex2_json, ensure_ascii=False)))
     
-    return example_images
+    return tuple(example_images)
 
+@functools.lru_cache(maxsize=1)
 def get_scene_to_sound_prompt():
-    """audio_prompt.py의 함수를 포함한 프롬프트 생성"""
-    from audio_prompt import generate_prompts
-    
+    """audio_prompt.py의 함수를 포함한 프롬프트 생성 (결과는 캐시되므로 (str, tuple)로 반환)"""
     # audio_prompt.py의 함수를 문자열로 변환
     audio_prompt_func = f"""
 def generate_prompts(data: dict, custom_templates: dict = None) -> list[dict]:
@@ -151,4 +154,4 @@ JSON Output Example 2:
 {ex2_json}
 """
     
-    return prompt, example_images
+    return prompt, tuple(example_images)
@@ -1,26 +1,185 @@
 import os
+import copy
 import json
-import re
+import hashlib
+import functools
+import importlib.util
+from collections import OrderedDict
 from PIL import Image
 import torch
 from datetime import datetime
 import traceback
 from typing import Tuple
 from huggingface_hub import snapshot_download
+try:
+    import diskcache
+except ImportError:  # 선택 의존성: 없으면 응답 캐시 비활성화
+    diskcache = None
 from transformers import (
     Qwen2VLForConditionalGeneration,
     AutoProcessor,
+    BatchFeature,
+    StoppingCriteria,
+    StoppingCriteriaList,
 )
 
 
+# few-shot 예시 이미지 전처리 결과 캐시 (배치 내내 동일하므로 한 번만 계산)
+_EXAMPLE_FEATURES = {}
+
+# static KV cache를 지원하지 않는 환경이면 False로 바뀌고 이후 dynamic cache 사용
+_STATIC_CACHE_SUPPORTED = True
+
+# static KV cache 사용 시 프롬프트 길이를 이 배수로 left padding (shape 종류를 줄여 재컴파일 방지)
+_STATIC_PAD_MULTIPLE = 64
+
+# few-shot 프리픽스 KV cache 재사용이 실패하는 환경이면 False로 바뀌고 이후 전체 prefill 사용
+_PREFIX_CACHE_SUPPORTED = True
+
+# model.generate 기본 디코딩 설정 (단일/배치 경로 공통)
+# greedy: JSON 출력에 충분하고 샘플러 오버헤드가 없음 (샘플링은 generation_kwargs로)
+_GENERATION_KWARGS = dict(max_new_tokens=1024, do_sample=False)
+
+# HF 캐시 환경 변수 설정을 이미 마쳤는지 여부
+_HF_READY = False
+
+# 비전 타워 출력 캐시에 보관할 최대 이미지 수
+_VISION_CACHE_SIZE = 32
+
+# 최종 JSON 응답 디스크 캐시 (VLM_CACHE=1일 때만 사용)
+_RESPONSE_CACHE_DIR = os.environ.get("VLM_CACHE_DIR", ".vlm_cache")
+_RESPONSE_CACHE_SIZE_LIMIT = int(os.environ.get("VLM_CACHE_SIZE_LIMIT", 2 ** 30))
+_RESPONSE_CACHE = None
+_RESPONSE_CACHE_DISABLED = False  # diskcache 미설치 시 경고를 한 번만 출력하기 위한 플래그
+
+# 응답 문자열에서 JSON 객체를 찾아 파싱할 디코더
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _image_key(image):
+    """PIL 이미지 내용(모드/크기/픽셀)의 SHA-256 해시"""
+    digest = hashlib.sha256(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class _VisionEmbeddingCache:
+    """이미지 해시 -> 비전 타워(ViT + merger) 출력 LRU 캐시 (visual.forward 자리에 설치)"""
+
+    def __init__(self, visual, maxsize=_VISION_CACHE_SIZE):
+        self.visual_forward = visual.forward
+        self.merge_length = getattr(visual, "spatial_merge_size", 2) ** 2
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.pending_keys = None
+
+    def __call__(self, pixel_values, grid_thw=None, **kwargs):
+        # generate 직전에 넘겨받은 이미지 해시는 prefill의 첫 호출에서만 사용
+        keys, self.pending_keys = self.pending_keys, None
+        if keys is None or grid_thw is None or len(keys) != len(grid_thw):
+            return self.visual_forward(pixel_values, grid_thw=grid_thw, **kwargs)
+
+        # pixel_values는 이미지별 (t*h*w)개 패치 행이 이어 붙은 형태
+        patch_counts = grid_thw.prod(-1).tolist()
+        # 배치 안에서 반복되는 예시 이미지는 한 번만 계산
+        missing = []
+        seen = set()
+        for i, key in enumerate(keys):
+            if key not in self.entries and key not in seen:
+                seen.add(key)
+                missing.append(i)
+        if missing:
+            patches = torch.split(pixel_values, patch_counts)
+            embeds = self.visual_forward(
+                torch.cat([patches[i] for i in missing]), grid_thw=grid_thw[missing], **kwargs
+            )
+            if not isinstance(embeds, torch.Tensor):
+                # 출력 형식이 다른 transformers 버전이면 캐시 없이 전체 실행
+                return self.visual_forward(pixel_values, grid_thw=grid_thw, **kwargs)
+            token_counts = [patch_counts[i] // self.merge_length for i in missing]
+            for i, embed in zip(missing, torch.split(embeds, token_counts)):
+                self.entries[keys[i]] = embed
+
+        for key in keys:
+            self.entries.move_to_end(key)
+        result = torch.cat([self.entries[key] for key in keys])
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return result
+
+
+class _JsonCompleteCriteria(StoppingCriteria):
+    """생성 중인 행별로 중괄호 깊이를 추적해 첫 JSON 객체가 닫히면 그 행의 생성을 종료"""
+
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.processed = prompt_length
+        self.states = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.states is None:
+            # 행별 [깊이, 문자열 내부 여부, 직전 문자가 이스케이프인지, 완료 여부]
+            self.states = [[0, False, False, False] for _ in range(input_ids.shape[0])]
+
+        # 지난 호출 이후 새로 생성된 토큰만 디코딩 (보통 한 토큰)
+        new_texts = self.tokenizer.batch_decode(input_ids[:, self.processed:], skip_special_tokens=True)
+        self.processed = input_ids.shape[1]
+
+        for state, text in zip(self.states, new_texts):
+            if state[3]:
+                continue
+            depth, in_string, escaped = state[0], state[1], state[2]
+            for ch in text:
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif ch == '\\':
+                        escaped = True
+                    elif ch == '"':
+                        in_string = False
+                elif ch == '"':
+                    in_string = depth > 0
+                elif ch == '{':
+                    depth += 1
+                elif ch == '}' and depth > 0:
+                    depth -= 1
+                    if depth == 0:
+                        state[3] = True
+                        break
+            state[0], state[1], state[2] = depth, in_string, escaped
+
+        return torch.tensor([state[3] for state in self.states], dtype=torch.bool, device=input_ids.device)
+
+
+def _json_stopping_criteria(processor, inputs):
+    """JSON 객체가 닫히는 즉시 생성을 멈추는 stopping_criteria (max_new_tokens까지 디코딩하지 않도록)"""
+    return StoppingCriteriaList([_JsonCompleteCriteria(processor.tokenizer, inputs.input_ids.shape[1])])
+
+
+def _install_vision_cache(model):
+    """모델의 비전 타워 forward를 해시 기반 캐시로 감싼다"""
+    # 최신 transformers는 model.model.visual, 이전 버전은 model.visual
+    visual = getattr(getattr(model, "model", None), "visual", None)
+    if visual is None:
+        visual = getattr(model, "visual", None)
+    if visual is None:
+        return
+    model._vision_cache = _VisionEmbeddingCache(visual)
+    visual.forward = model._vision_cache
+
+
 def _ensure_hf_caches_on_windows():
     """Set HF cache envs to safe paths (avoid symlinks issues on Windows)."""
+    global _HF_READY
+    if _HF_READY:
+        return
     if "HF_HOME" not in os.environ:
         os.environ["HF_HOME"] = os.path.join(os.path.expanduser("~"), ".cache", "hf_home")
     if "HF_HUB_CACHE" not in os.environ:
         os.environ["HF_HUB_CACHE"] = os.path.join(os.path.expanduser("~"), ".cache", "hf_home", "hub")
     if "TRANSFORMERS_CACHE" not in os.environ:
         os.environ["TRANSFORMERS_CACHE"] = os.path.join(os.path.expanduser("~"), ".cache", "hf_home", "transformers")
+    _HF_READY = True
 
 
 def _download_snapshot(model_id: str, local_dir: str) -> str:
@@ -35,31 +194,129 @@ def _download_snapshot(model_id: str, local_dir: str) -> str:
     return local_dir
 
 
+def _compile_language_model(model):
+    """LM 디코더만 torch.compile (이미지 크기마다 shape가 바뀌는 비전 타워는 재컴파일 방지를 위해 제외)"""
+    # 몇 가지 프롬프트/배치 shape 조합을 수용하도록 재컴파일 한도 상향
+    torch._dynamo.config.cache_size_limit = 64
+    # 기본 경로(batch 1 + 예시 프리픽스)는 길이가 계속 늘어나는 DynamicCache를 쓰므로
+    # reduce-overhead(CUDA graph)는 KV 길이마다 그래프를 새로 캡처함 -> 기본 모드 + dynamic shape로 컴파일
+    inner = model.model
+    if hasattr(inner, "language_model"):
+        # 최신 transformers: model.model = (visual + language_model)
+        inner.language_model = torch.compile(inner.language_model, dynamic=True, fullgraph=False)
+    else:
+        # 이전 transformers: model.model 자체가 LM, 비전 타워는 model.visual
+        model.model = torch.compile(inner, dynamic=True, fullgraph=False)
+
+
+def _warmup(model, processor):
+    """더미 이미지로 짧게 생성해 컴파일 비용을 첫 실제 호출 전에 지불"""
+    print("🔥 VLM 워밍업 중...")
+    messages = [{
+        "role": "user",
+        "content": [
+            {"type": "image", "image": "warmup"},
+            {"type": "text", "text": "Describe this image."}
+        ]
+    }]
+    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    inputs = processor(
+        text=[text],
+        images=[Image.new('RGB', (224, 224))],
+        padding=True,
+        return_tensors="pt"
+    ).to(model.device)
+    # 기본 경로(프리픽스 KV cache 재사용)와 같은 dynamic cache로 실행
+    # static cache는 프롬프트 길이/생성 길이마다 크기가 달라 더미 입력으로는 재사용되지 않으므로 첫 실제 배치에서 할당
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens=8, do_sample=False)
+
+
 def load_qwen_vl(
     model_id: str = "Qwen/Qwen2-VL-7B-Instruct",
     cache_subdir: str = "qwen2-vl-7b-instruct",
+    compile_model: bool = True,
+    quantize: str = None,
 ) -> Tuple[Qwen2VLForConditionalGeneration, AutoProcessor]:
     _ensure_hf_caches_on_windows()
 
     local_dir = os.path.join(os.environ["TRANSFORMERS_CACHE"], cache_subdir)
     _download_snapshot(model_id=model_id, local_dir=local_dir)
 
-    torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+    if torch.cuda.is_available():
+        # Ampere 이상은 bf16 (fp16 overflow 없음), 그 외 GPU는 fp16
+        torch_dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+    else:
+        torch_dtype = torch.float32
+
+    # flash-attn 설치 + GPU면 FlashAttention-2, 아니면 PyTorch SDPA
+    if torch.cuda.is_available() and importlib.util.find_spec("flash_attn") is not None:
+        attn_implementation = "flash_attention_2"
+    else:
+        attn_implementation = "sdpa"
+
+    model_kwargs = {}
+    if quantize and torch.cuda.is_available():
+        # LM 가중치만 bitsandbytes로 양자화 (비전 타워는 작고 품질에 민감하므로 원래 dtype 유지)
+        from transformers import BitsAndBytesConfig
+
+        if quantize == "4bit":
+            model_kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch_dtype,
+                bnb_4bit_quant_type="nf4",
+                llm_int8_skip_modules=["visual", "lm_head"],
+            )
+        elif quantize == "8bit":
+            model_kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_8bit=True,
+                llm_int8_skip_modules=["visual", "lm_head"],
+            )
+        else:
+            raise ValueError(f"지원하지 않는 quantize 값: {quantize} ('4bit' 또는 '8bit')")
 
     model = Qwen2VLForConditionalGeneration.from_pretrained(
         local_dir,
         dtype=torch_dtype,
+        attn_implementation=attn_implementation,
         device_map="auto",
         trust_remote_code=True,
+        **model_kwargs,
     )
-    processor = AutoProcessor.from_pretrained(
-        local_dir,
-        trust_remote_code=True
-    )
+    # torchvision 기반 Qwen2VLImageProcessorFast (rescale/normalize/patchify를 텐서 연산 한 번에)
+    try:
+        processor = AutoProcessor.from_pretrained(
+            local_dir,
+            trust_remote_code=True,
+            use_fast=True,
+        )
+    except (ValueError, TypeError, ImportError) as e:
+        print(f"⚠️ fast 이미지 프로세서 사용 불가, 기본 프로세서 사용: {str(e)}")
+        processor = AutoProcessor.from_pretrained(
+            local_dir,
+            trust_remote_code=True
+        )
+    # 배치 생성 시 프롬프트 끝이 맞춰지도록 left padding
+    processor.tokenizer.padding_side = "left"
+    _install_vision_cache(model)
+
+    # bitsandbytes 커널은 dynamo 그래프가 끊기므로 양자화 시에는 컴파일하지 않음
+    if compile_model and not model_kwargs and torch.cuda.is_available() and hasattr(torch, "compile"):
+        _compile_language_model(model)
+        _warmup(model, processor)
     return model, processor
 
 
+def build_generation_kwargs(temperature: float = 0.0) -> dict:
+    """model.generate 디코딩 설정 생성 (temperature > 0이면 top_p=0.8 샘플링)"""
+    if temperature > 0:
+        return dict(max_new_tokens=1024, do_sample=True, temperature=temperature, top_p=0.8)
+    return dict(_GENERATION_KWARGS)
+
+
+@functools.lru_cache(maxsize=4)
 def _strip_examples_from_prompt(prompt_text):
+    # 프롬프트는 배치 내내 같으므로 이미지마다 split하지 않고 한 번만 계산
     marker = "Final Output"
     if marker in prompt_text:
         parts = prompt_text.split(marker, 1)
@@ -67,81 +324,287 @@ def _strip_examples_from_prompt(prompt_text):
     return prompt_text
 
 
-def generate_sound_json(model, processor, image_path, prompt, use_few_shot=True, example_images=None):
+def _get_example_features(processor, images):
+    """예시 이미지들의 pixel_values / image_grid_thw와 내용 해시를 한 번만 계산해 재사용"""
+    # 예시 이미지는 load_example_data가 프로세스 내내 같은 객체로 유지하므로 id로 구분
+    # (캐시 값에 이미지 참조를 함께 보관해 id가 재사용되지 않도록 함)
+    cache_key = tuple(id(img) for img in images)
+    cached = _EXAMPLE_FEATURES.get(cache_key)
+    if cached is None:
+        features = processor.image_processor(images=list(images), return_tensors="pt")
+        cached = (tuple(images), features, [_image_key(img) for img in images])
+        _EXAMPLE_FEATURES[cache_key] = cached
+    return cached[1], cached[2]
+
+
+def _build_inputs(processor, texts, image_features, pad_to_multiple_of=None):
+    """전처리된 이미지 특징들로 processor(text=..., images=...)와 같은 입력 생성"""
+    if not image_features:
+        return processor(text=texts, padding=True, pad_to_multiple_of=pad_to_multiple_of, return_tensors="pt")
+
+    # GPU가 있으면 pinned 메모리에 바로 이어 붙여 .to(non_blocking=True) 비동기 복사가 가능하도록
+    pixel_list = [f["pixel_values"] for f in image_features]
+    pixel_values = torch.empty(
+        (sum(p.shape[0] for p in pixel_list), *pixel_list[0].shape[1:]),
+        dtype=pixel_list[0].dtype,
+        pin_memory=torch.cuda.is_available(),
+    )
+    torch.cat(pixel_list, out=pixel_values)
+    image_grid_thw = torch.cat([f["image_grid_thw"] for f in image_features])
+
+    # 이미지마다 <|image_pad|> 토큰을 (grid 패치 수 / merge_size^2)개로 확장
+    image_token = getattr(processor, "image_token", "<|image_pad|>")
+    merge_length = processor.image_processor.merge_size ** 2
+    expanded_texts = []
+    index = 0
+    for text in texts:
+        parts = text.split(image_token)
+        pieces = [parts[0]]
+        for part in parts[1:]:
+            pieces.append(image_token * int(image_grid_thw[index].prod() // merge_length))
+            pieces.append(part)
+            index += 1
+        expanded_texts.append("".join(pieces))
+
+    text_inputs = processor.tokenizer(
+        expanded_texts, padding=True, pad_to_multiple_of=pad_to_multiple_of, return_tensors="pt"
+    )
+    return BatchFeature(data={
+        **text_inputs,
+        "pixel_values": pixel_values,
+        "image_grid_thw": image_grid_thw,
+    })
+
+
+def _generate(model, inputs, static_cache=False, **generate_kwargs):
+    """model.generate 호출 (static_cache=True면 고정 shape KV cache 사용, 프리픽스 경로에서는 사용하지 않음)"""
+    global _STATIC_CACHE_SUPPORTED
+    with torch.no_grad():
+        if static_cache and _STATIC_CACHE_SUPPORTED and model.device.type == "cuda":
+            try:
+                return model.generate(**inputs, cache_implementation="static", **generate_kwargs)
+            except (ValueError, TypeError, NotImplementedError) as e:
+                print(f"⚠️ static KV cache 사용 불가, 기본 cache로 전환: {str(e)}")
+                _STATIC_CACHE_SUPPORTED = False
+        return model.generate(**inputs, **generate_kwargs)
+
+
+def _forward_for_cache(model, **inputs):
+    """KV cache만 필요한 forward 후 cache 반환 (가능하면 마지막 위치 logits만 계산해 vocab 크기 출력 생략)"""
+    with torch.no_grad():
+        try:
+            outputs = model(**inputs, use_cache=True, logits_to_keep=1)
+        except TypeError:
+            outputs = model(**inputs, use_cache=True)
+        return outputs.past_key_values
+
+
+def _get_prefix_cache(model, processor, prefix_text, example_features, example_keys):
+    """few-shot 예시 대화(대상 이미지 제외) 부분의 input_ids와 KV cache를 한 번만 계산해 model에 보관"""
+    cache_key = (prefix_text, tuple(example_keys))
+    cached = getattr(model, "_prefix_kv", None)
+    if cached is None or cached[0] != cache_key:
+        prefix_inputs = _build_inputs(processor, [prefix_text], [example_features]).to(model.device)
+        _set_vision_keys(model, example_keys)
+        cached = (cache_key, prefix_inputs.input_ids, _forward_for_cache(model, **prefix_inputs))
+        model._prefix_kv = cached
+    return cached[1], cached[2]
+
+
+def _rope_owner(model):
+    """M-RoPE 위치 계산(get_rope_index)과 rope_deltas를 가진 모듈 반환 (transformers 버전별 위치가 다름)"""
+    for module in (model, getattr(model, "model", None)):
+        if module is not None and hasattr(module, "get_rope_index") and hasattr(module, "rope_deltas"):
+            return module
+    return None
+
+
+def _generate_with_prefix(model, inputs, prefix_ids, prefix_kv, target_key, **generate_kwargs):
+    """프리픽스 KV cache 복사본에 대상 이미지 + 질문 부분만 prefill한 뒤 생성 (재사용 불가하면 None)"""
+    rope_owner = _rope_owner(model)
+    input_ids = inputs.input_ids
+    prefix_len = prefix_ids.shape[1]
+    seq_len = input_ids.shape[1]
+    if rope_owner is None or seq_len <= prefix_len + 1 or not torch.equal(input_ids[:, :prefix_len], prefix_ids):
+        return None
+
+    # 전체 시퀀스 기준 3D(M-RoPE) 위치를 계산해 접미부 위치만 사용
+    position_ids, rope_deltas = rope_owner.get_rope_index(
+        input_ids, image_grid_thw=inputs.image_grid_thw, attention_mask=inputs.attention_mask
+    )
+    target_patches = int(inputs.image_grid_thw[-1].prod())
+    suffix = slice(prefix_len, seq_len - 1)
+
+    # forward가 넘겨받은 cache를 이어서 채우므로 프리픽스 cache는 복사본으로 전달
+    _set_vision_keys(model, [target_key])
+    past_key_values = _forward_for_cache(
+        model,
+        input_ids=input_ids[:, suffix],
+        attention_mask=inputs.attention_mask[:, :seq_len - 1],
+        position_ids=position_ids[:, :, suffix],
+        pixel_values=inputs.pixel_values[-target_patches:],
+        image_grid_thw=inputs.image_grid_thw[-1:],
+        past_key_values=copy.deepcopy(prefix_kv),
+        cache_position=torch.arange(prefix_len, seq_len - 1, device=input_ids.device),
+    )
+
+    # 마지막 토큰부터는 generate가 cache_position + rope_deltas로 위치를 이어서 계산
+    rope_owner.rope_deltas = rope_deltas
+    with torch.no_grad():
+        return model.generate(
+            input_ids=input_ids,
+            attention_mask=inputs.attention_mask,
+            past_key_values=past_key_values,
+            **generate_kwargs,
+        )
+
+
+def prepare_image(processor, image_path):
+    """대상 이미지 디코딩 + 전처리 + 내용 해시를 미리 계산 (로더 스레드에서 GPU 추론과 겹쳐 실행)"""
+    image = _decode_image(image_path)
+    features = processor.image_processor(images=[image], return_tensors="pt")
+    return image, features, _image_key(image)
+
+
+def _decode_image(image_path):
+    """대상 이미지를 RGB PIL 이미지로 한 번만 디코딩"""
+    return Image.open(image_path).convert('RGB')
+
+
+def _build_messages(core_instruction, example_images, image):
+    """few-shot 예시들 + 대상 이미지로 대화 메시지 생성"""
+    messages = []
+    
+    # Few-shot 예시들 추가 (예시 이미지는 이미 디코딩된 PIL 이미지)
+    for ex_img, ex_json in example_images:
+        messages.extend([
+            {
+                "role": "user", 
+                "content": [
+                    {"type": "image", "image": ex_img},
+                    {"type": "text", "text": "Analyze this image and generate a sound source JSON."}
+                ]
+            },
+            {"role": "assistant", "content": ex_json}
+        ])
+    
+    # 현재 처리할 이미지 추가
+    messages.append({
+        "role": "user",
+        "content": [
+            {"type": "image", "image": image},
+            {"type": "text", "text": core_instruction + " Output only the JSON object."}
+        ]
+    })
+    return messages
+
+
+def _collect_image_features(processor, example_images, image, prepared=None):
+    """메시지 순서대로 이미지 특징과 내용 해시 수집 (예시는 캐시된 전처리 결과, 대상은 prepared 재사용)"""
+    image_features = []
+    image_keys = []
+    if example_images:
+        example_features, example_keys = _get_example_features(processor, [ex_img for ex_img, _ in example_images])
+        image_features.append(example_features)
+        image_keys.extend(example_keys)
+    if prepared is not None:
+        image_features.append(prepared[1])
+        image_keys.append(prepared[2])
+    elif image is not None:
+        image_features.append(processor.image_processor(images=[image], return_tensors="pt"))
+        image_keys.append(_image_key(image))
+    return image_features, image_keys
+
+
+def _set_vision_keys(model, image_keys):
+    """비전 타워 캐시에 이번 입력 이미지들의 해시 전달 (캐시된 이미지는 ViT 재실행 생략)"""
+    vision_cache = getattr(model, "_vision_cache", None)
+    if vision_cache is not None:
+        vision_cache.pending_keys = image_keys
+
+
+def _decode_generated(processor, inputs, generated_ids):
+    """입력 프롬프트 부분을 잘라내고 생성된 토큰만 디코딩"""
+    # left padding이라 모든 행의 프롬프트 길이가 input_ids.shape[1]로 같으므로 한 번에 슬라이스
+    generated_ids = generated_ids[:, inputs.input_ids.shape[1]:]
+    return processor.batch_decode(
+        generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
+    )
+
+
+def _generate_sound_json_with_prefix(model, processor, inputs, prefix_text, example_features, image_keys,
+                                     gen_kwargs):
+    """프리픽스 KV cache 재사용 경로 (실패하면 이후로는 사용하지 않고 None 반환)"""
+    global _PREFIX_CACHE_SUPPORTED
+    try:
+        prefix_ids, prefix_kv = _get_prefix_cache(model, processor, prefix_text, example_features, image_keys[:-1])
+        return _generate_with_prefix(
+            model,
+            inputs,
+            prefix_ids,
+            prefix_kv,
+            image_keys[-1],
+            stopping_criteria=_json_stopping_criteria(processor, inputs),
+            **gen_kwargs,
+        )
+    except torch.cuda.OutOfMemoryError:
+        # 메모리 부족은 경로 비호환이 아니므로 비활성화하지 않고 그대로 전달
+        raise
+    except (ValueError, TypeError, RuntimeError, AttributeError, IndexError) as e:
+        print(f"⚠️ 프리픽스 KV cache 재사용 불가, 전체 prefill로 전환: {str(e)}")
+        _PREFIX_CACHE_SUPPORTED = False
+        model._prefix_kv = None
+        return None
+
+
+def generate_sound_json(model, processor, image_path, prompt, use_few_shot=True, example_images=None,
+                        static_cache=False, prepared=None, generation_kwargs=None):
     try:
         core_instruction = _strip_examples_from_prompt(prompt)
+        examples = example_images if use_few_shot and example_images else ()
         
-        messages = []
+        # 메시지와 전처리 모두 같은 PIL 이미지를 사용 (경로를 넘겨 프로세서가 다시 디코딩하지 않도록)
+        image = prepared[0] if prepared is not None else _decode_image(image_path)
         
-        if use_few_shot and example_images:
-            # Few-shot 예시들 추가
-            for ex_img_path, ex_json in example_images:
-                if os.path.exists(ex_img_path):
-                    messages.extend([
-                        {
-                            "role": "user", 
-                            "content": [
-                                {"type": "image", "image": ex_img_path},
-                                {"type": "text", "text": "Analyze this image and generate a sound source JSON."}
-                            ]
-                        },
-                        {"role": "assistant", "content": ex_json}
-                    ])
-        
-        # 현재 처리할 이미지 추가
-        messages.append({
-            "role": "user",
-            "content": [
-                {"type": "image", "image": image_path},
-                {"type": "text", "text": core_instruction + " Output only the JSON object."}
-            ]
-        })
+        messages = _build_messages(core_instruction, examples, image)
         
         # 텍스트 생성
         text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
         
-        # 이미지들 수집 및 로드
-        image_inputs = []
-        for message in messages:
-            if message["role"] == "user":
-                for content in message["content"]:
-                    if content.get("type") == "image":
-                        img_path = content["image"]
-                        if os.path.exists(img_path):
-                            img = Image.open(img_path).convert('RGB')
-                            image_inputs.append(img)
+        # 예시 이미지는 캐시된 전처리 결과를 재사용하고 대상 이미지만 새로 전처리
+        image_features, image_keys = _collect_image_features(processor, examples, image, prepared)
         
-        print(f"처리 중인 이미지들: {len(image_inputs)}개")
+        print(f"처리 중인 이미지들: {len(image_keys)}개")
         
-        # 프로세서 호출
-        inputs = processor(
-            text=[text],
-            images=image_inputs,
-            padding=True,
-            return_tensors="pt"
-        )
-        inputs = inputs.to(model.device)
+        gen_kwargs = generation_kwargs if generation_kwargs is not None else _GENERATION_KWARGS
+        use_prefix = bool(examples) and _PREFIX_CACHE_SUPPORTED
         
-        with torch.no_grad():
-            generated_ids = model.generate(
-                **inputs,
-                max_new_tokens=1024,
-                do_sample=True,
-                temperature=0.3,
-                top_p=0.8,
-            )
+        # 프로세서 호출 (텍스트 토큰화 + 이미지 특징 결합)
+        # static cache 경로만 길이 버킷팅 (프리픽스 경로는 left padding이 들어가면 프리픽스가 어긋남)
+        pad_multiple = _STATIC_PAD_MULTIPLE if static_cache and not use_prefix else None
+        inputs = _build_inputs(processor, [text], image_features, pad_to_multiple_of=pad_multiple)
+        inputs = inputs.to(model.device, non_blocking=True)
         
-        # 디코딩
-        generated_ids = [
-            output_ids[len(input_ids):] 
-            for input_ids, output_ids in zip(inputs.input_ids, generated_ids)
-        ]
+        generated_ids = None
+        if use_prefix:
+            # 예시 대화까지의 KV cache는 모든 이미지가 공유하므로 대상 이미지 부분만 prefill
+            prefix_text = processor.apply_chat_template(messages[:-1], tokenize=False, add_generation_prompt=False)
+            generated_ids = _generate_sound_json_with_prefix(
+                model, processor, inputs, prefix_text, image_features[0], image_keys, gen_kwargs
+            )
         
-        response = processor.batch_decode(
-            generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )[0]
+        if generated_ids is None:
+            _set_vision_keys(model, image_keys)
+            generated_ids = _generate(
+                model,
+                inputs,
+                static_cache=static_cache,
+                stopping_criteria=_json_stopping_criteria(processor, inputs),
+                **gen_kwargs,
+            )
         
-        return response
+        # 디코딩
+        return _decode_generated(processor, inputs, generated_ids)[0]
         
     except Exception as e:
         print(f"오류 발생: {str(e)}")
@@ -150,35 +613,200 @@ def generate_sound_json(model, processor, image_path, prompt, use_few_shot=True,
         return f"Error: {str(e)}"
 
 
+def generate_sound_json_batch(model, processor, image_paths, prompt, example_images=None, batch_size=8,
+                              static_cache=False, prepared=None, generation_kwargs=None):
+    """여러 이미지를 batch_size개씩 묶어 한 번의 model.generate로 처리하고 이미지별 응답 리스트 반환"""
+    gen_kwargs = generation_kwargs if generation_kwargs is not None else _GENERATION_KWARGS
+    core_instruction = _strip_examples_from_prompt(prompt)
+    examples = example_images or ()
+    if prepared is None:
+        prepared = [None] * len(image_paths)
+    
+    responses = []
+    for start in range(0, len(image_paths), batch_size):
+        chunk_paths = image_paths[start:start + batch_size]
+        try:
+            texts = []
+            image_features = []
+            image_keys = []
+            for image_path, ready in zip(chunk_paths, prepared[start:start + batch_size]):
+                image = ready[0] if ready is not None else _decode_image(image_path)
+                messages = _build_messages(core_instruction, examples, image)
+                texts.append(processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True))
+                features, keys = _collect_image_features(processor, examples, image, ready)
+                image_features.extend(features)
+                image_keys.extend(keys)
+            
+            print(f"배치 처리 중인 이미지들: {len(chunk_paths)}개 (예시 포함 {len(image_keys)}개)")
+            
+            # left padding으로 묶어서 한 번에 prefill + decode
+            inputs = _build_inputs(processor, texts, image_features,
+                                   pad_to_multiple_of=_STATIC_PAD_MULTIPLE if static_cache else None)
+            inputs = inputs.to(model.device, non_blocking=True)
+            _set_vision_keys(model, image_keys)
+            
+            generated_ids = _generate(
+                model,
+                inputs,
+                static_cache=static_cache,
+                pad_token_id=processor.tokenizer.pad_token_id,
+                stopping_criteria=_json_stopping_criteria(processor, inputs),
+                **gen_kwargs,
+            )
+            responses.extend(_decode_generated(processor, inputs, generated_ids))
+            
+        except Exception as e:
+            print(f"오류 발생: {str(e)}")
+            traceback.print_exc()
+            responses.extend([f"Error: {str(e)}"] * len(chunk_paths))
+    
+    return responses
+
+
+def _skip_object(text, start):
+    """start의 '{'와 짝이 맞는 '}' 다음 위치를 반환 (문자열 안의 괄호는 무시, 짝이 없으면 -1)"""
+    depth = 0
+    in_string = False
+    escaped = False
+    for pos in range(start, len(text)):
+        ch = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+    return -1
+
+
 def parse_json_response(response):
-    try:
-        json_match = re.search(r'\{.*\}', response, re.DOTALL)
-        if json_match:
-            json_str = json_match.group()
-            parsed_json = json.loads(json_str)
+    # 첫 '{'부터 raw_decode로 파싱 (정규식 백트래킹 없음, JSON 뒤의 설명 문장도 무시)
+    first_error = None
+    idx = response.find('{')
+    while idx >= 0:
+        try:
+            parsed_json, _ = _JSON_DECODER.raw_decode(response, idx)
             return {
                 "success": True,
                 "json_data": parsed_json,
                 "raw_response": response
             }
-        else:
-            return {
-                "success": False,
-                "json_data": None,
-                "raw_response": response,
-                "error": "No JSON found in response"
-            }
-    except json.JSONDecodeError as e:
+        except json.JSONDecodeError as e:
+            if first_error is None:
+                first_error = e
+            # 실패한 객체 안쪽의 '{'(내부 조각)는 새 시작점으로 보지 않고 짝이 맞는 '}' 이후에서만 다시 탐색
+            end = _skip_object(response, idx)
+            idx = response.find('{', end) if end >= 0 else -1
+    
+    if first_error is not None:
         return {
             "success": False,
             "json_data": None,
             "raw_response": response,
-            "error": f"JSON parsing error: {str(e)}"
+            "error": f"JSON parsing error: {str(first_error)}"
         }
+    return {
+        "success": False,
+        "json_data": None,
+        "raw_response": response,
+        "error": "No JSON found in response"
+    }
+
+
+def _get_response_cache():
+    """VLM_CACHE=1이고 diskcache가 설치되어 있으면 응답 캐시를 반환 (아니면 None)"""
+    global _RESPONSE_CACHE, _RESPONSE_CACHE_DISABLED
+    if os.environ.get("VLM_CACHE") != "1" or _RESPONSE_CACHE_DISABLED:
+        return None
+    if _RESPONSE_CACHE is None:
+        if diskcache is None:
+            print("⚠️ diskcache가 설치되어 있지 않아 VLM 응답 캐시를 사용하지 않습니다.")
+            _RESPONSE_CACHE_DISABLED = True
+            return None
+        _RESPONSE_CACHE = diskcache.Cache(_RESPONSE_CACHE_DIR, size_limit=_RESPONSE_CACHE_SIZE_LIMIT,
+                                          eviction_policy="least-recently-used")
+    return _RESPONSE_CACHE
+
+
+def _config_digest(model, gen_kwargs):
+    """응답에 영향을 주는 설정(모델 ID, 양자화, 디코딩 옵션)의 해시"""
+    gen_kwargs = gen_kwargs if gen_kwargs is not None else _GENERATION_KWARGS
+    config = getattr(model, "config", None)
+    quantization_config = getattr(config, "quantization_config", None)
+    if hasattr(quantization_config, "to_dict"):
+        quantization_config = quantization_config.to_dict()
+    parts = {
+        "model": getattr(config, "_name_or_path", None),
+        "quantization": quantization_config,
+        "generation": gen_kwargs,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _response_key(image_path, prepared, prompt, config_digest):
+    """이미지 파일 바이트 해시 + 프롬프트 해시 + 설정 해시로 응답 캐시 키 생성"""
+    if os.path.exists(image_path):
+        with open(image_path, 'rb') as f:
+            image_hash = hashlib.sha256(f.read()).hexdigest()
+    elif prepared is not None:
+        image_hash = prepared[2]
+    else:
+        return None
+    return image_hash + ":" + hashlib.sha256(prompt.encode()).hexdigest() + ":" + config_digest
+
+
+def process_images_with_vlm_batch(model, processor, image_paths, prompt, example_images=None,
+                                  batch_size=8, static_cache=False, prepared=None, generation_kwargs=None):
+    """여러 이미지를 배치로 VLM 처리하고 이미지별 JSON 결과 리스트를 반환 (prepared: prepare_image 결과들, 선택)"""
+    if prepared is None:
+        prepared = [None] * len(image_paths)
+    
+    cache = _get_response_cache()
+    digest = _config_digest(model, generation_kwargs) if cache is not None else None
+    keys = [_response_key(path, ready, prompt, digest) if cache is not None else None
+            for path, ready in zip(image_paths, prepared)]
+    results = [cache.get(key) if key is not None else None for key in keys]
+    
+    # 캐시에 없는 이미지만 모델로 처리
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        responses = generate_sound_json_batch(model, processor, [image_paths[i] for i in missing], prompt,
+                                              example_images, batch_size=batch_size,
+                                              static_cache=static_cache,
+                                              prepared=[prepared[i] for i in missing],
+                                              generation_kwargs=generation_kwargs)
+        for i, response in zip(missing, responses):
+            results[i] = parse_json_response(response)
+            if keys[i] is not None and results[i]["success"]:
+                cache.set(keys[i], results[i])
+    return results
 
 
-def process_image_with_vlm(model, processor, image_path, prompt, example_images=None):
-    """VLM을 사용하여 이미지를 처리하고 JSON 결과를 반환"""
-    response = generate_sound_json(model, processor, image_path, prompt, use_few_shot=True, example_images=example_images)
+def process_image_with_vlm(model, processor, image_path, prompt, example_images=None, static_cache=False,
+                           prepared=None, generation_kwargs=None):
+    """VLM을 사용하여 이미지를 처리하고 JSON 결과를 반환 (prepared: prepare_image 결과, 선택)"""
+    cache = _get_response_cache()
+    key = (_response_key(image_path, prepared, prompt, _config_digest(model, generation_kwargs))
+           if cache is not None else None)
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            print(f"💾 응답 캐시 적중: {os.path.basename(image_path)}")
+            return cached
+    
+    response = generate_sound_json(model, processor, image_path, prompt, use_few_shot=True, example_images=example_images,
+                                   static_cache=static_cache, prepared=prepared,
+                                   generation_kwargs=generation_kwargs)
     parsed = parse_json_response(response)
+    if key is not None and parsed["success"]:
+        cache.set(key, parsed)
     return parsed
\ No newline at end of file